@@ -1,28 +1,76 @@
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from transformers import (
+    AutoTokenizer,
+    AutoModelForCausalLM,
+    BitsAndBytesConfig,
+    CompileConfig,
+    DynamicCache,
+    StaticCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
+from transformers.generation.streamers import BaseStreamer
 import torch
+import asyncio
+import atexit
+import copy
+import importlib.util
+import json
 import logging
+import logging.handlers
+import os
+import queue
 import sys
+import threading
 import traceback
+import uuid
+
+try:
+    from transformers import QuantizedCache
+except ImportError:  # Older transformers versions without quantized KV cache support
+    QuantizedCache = None
 
 # -----------------------------------------------------------------------------
 # Logging Configuration
 # -----------------------------------------------------------------------------
 # Configure logging to record server status and aid in debugging.
-# All logs at DEBUG level and above are recorded in the 'server.log' file and the console.
+# Logs at LOG_LEVEL (default: INFO; set LOG_LEVEL=DEBUG for details) and above are recorded in the
+# 'server.log' file and the console.
+# Request threads only put records on a queue; a QueueListener thread does the actual file and
+# console I/O, so slow writes never delay a request.
+log_handlers = [
+    logging.FileHandler("server.log"),  # Save logs to file
+    logging.StreamHandler(sys.stdout)   # Output logs to terminal
+]
+for handler in log_handlers:
+    handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)  # Flush remaining records on exit
+
 logging.basicConfig(
-    level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.FileHandler("server.log"),  # Save logs to file
-        logging.StreamHandler(sys.stdout)   # Output logs to terminal
-    ]
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
+    handlers=[logging.handlers.QueueHandler(log_queue)]
 )
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app):
+    """Runs the batching scheduler for as long as the server is up."""
+    scheduler = asyncio.create_task(batch_scheduler())
+    yield
+    scheduler.cancel()
+
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # -----------------------------------------------------------------------------
 # Configuration
@@ -43,12 +91,86 @@ def get_device():
 
 DEVICE = get_device()
 
+def is_package_available(name):
+    """Checks whether an optional package (e.g. 'bitsandbytes', 'optimum.quanto') is installed."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:  # Parent package of a dotted name is missing
+        return False
+
 # Data Type (Dtype) Selection:
 # Use float16 on GPU (cuda, mps) for memory efficiency and speed.
 # Use float32 on CPU for compatibility.
 DTYPE = torch.float16 if DEVICE in ["cuda", "mps"] else torch.float32
 
-logger.info(f"Loading model from {MODEL_PATH} on {DEVICE} (DTYPE: {DTYPE})...")
+# Weight Quantization:
+# Decoding is limited by how fast the weights can be read from memory, so smaller weights
+# speed it up roughly in proportion to the bytes saved compared to float16.
+# - "fp8": FP8 (E4M3) weight-only quantization via torchao on Hopper or newer GPUs (compute capability >= 9.0).
+# - "nf4": 4-bit NF4 weights via bitsandbytes on other CUDA GPUs.
+# - None: Other devices (or missing optional packages) keep DTYPE weights.
+def get_weight_quantization():
+    if DEVICE != "cuda":
+        return None
+    if torch.cuda.get_device_capability()[0] >= 9 and is_package_available("torchao"):
+        return "fp8"
+    if is_package_available("bitsandbytes"):
+        return "nf4"
+    return None
+
+WEIGHT_QUANTIZATION = get_weight_quantization()
+
+def get_attn_implementation():
+    """
+    Selects the attention kernel.
+    FlashAttention-2 needs an Ampere or newer GPU (compute capability >= 8.0) and the flash-attn package;
+    everything else uses PyTorch's fused scaled_dot_product_attention (SDPA) instead of the eager math path.
+    """
+    if DEVICE == "cuda" and torch.cuda.get_device_capability()[0] >= 8 and is_package_available("flash_attn"):
+        return "flash_attention_2"
+    return "sdpa"
+
+ATTN_IMPLEMENTATION = get_attn_implementation()
+
+# Compilation:
+# generate() compiles the decode step (not the prefill) with torch.compile(mode="reduce-overhead"),
+# which captures it into CUDA graphs and removes most of the per-token Python and kernel launch
+# overhead. It requires a static KV cache and is only enabled on CUDA.
+# bitsandbytes (NF4) weights cannot be compiled, so NF4 models run eagerly with a dynamic cache.
+COMPILE_MODEL = DEVICE == "cuda" and WEIGHT_QUANTIZATION != "nf4"
+
+# Maximum number of tokens (prompt + generated) the static KV cache can hold.
+MAX_CACHE_LEN = 2048
+
+# ONNX Runtime:
+# Without a CUDA GPU, a model exported with export-onnx.py runs on ONNX Runtime (CoreML on Apple Silicon),
+# whose fused attention and KV cache graphs are faster than eager PyTorch.
+# ONNX Runtime manages its own KV cache, so session prefix caching is not used with it.
+# Falls back to PyTorch when the model has not been exported or optimum[onnxruntime] is not installed.
+ONNX_MODEL_PATH = "models/gemma3-1b-it-onnx"
+USE_ONNX = (
+    DEVICE in ["cpu", "mps"]
+    and os.path.isdir(ONNX_MODEL_PATH)
+    and is_package_available("optimum.onnxruntime")
+)
+
+# KV Cache Quantization (opt-in, set QUANTIZE_KV_CACHE=1):
+# Stores keys/values as 4-bit (optimum-quanto backend), so long conversations use far less memory.
+# It saves memory capacity, not time: the cache is dequantized on every decoded token, so decoding is slower.
+# Only used without compilation, since CUDA graphs require the static float16 cache.
+QUANTIZE_KV_CACHE = (
+    os.getenv("QUANTIZE_KV_CACHE", "0") == "1"
+    and not COMPILE_MODEL
+    and not USE_ONNX
+    and QuantizedCache is not None
+    and is_package_available("optimum.quanto")
+)
+KV_CACHE_BITS = 4
+
+if USE_ONNX:
+    logger.info(f"Loading ONNX model from {ONNX_MODEL_PATH} on {DEVICE}...")
+else:
+    logger.info(f"Loading model from {MODEL_PATH} on {DEVICE} (DTYPE: {DTYPE}, Quantization: {WEIGHT_QUANTIZATION}, Attention: {ATTN_IMPLEMENTATION})...")
 
 # -----------------------------------------------------------------------------
 # Model & Tokenizer Loading
@@ -56,19 +178,70 @@ logger.info(f"Loading model from {MODEL_PATH} on {DEVICE} (DTYPE: {DTYPE})...")
 try:
     # Load Tokenizer: A tool that converts text into numbers (tokens) the model can understand.
     tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH)
+    if not tokenizer.is_fast:
+        logger.warning("Fast (Rust) tokenizer not available; batched tokenization will be slow.")
     
     # Load Model: Loads the actual language model into memory.
-    # For Apple Silicon (mps), device_map="auto" might not always work reliably, so we assign it manually.
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_PATH,
-        dtype=DTYPE,
-        device_map=DEVICE if DEVICE != "mps" else None, 
-    )
-    
-    # If using MPS, explicitly move the model to the device.
-    if DEVICE == "mps":
-        model = model.to(DEVICE)
-        
+    if USE_ONNX:
+        from optimum.onnxruntime import ORTModelForCausalLM
+        model = ORTModelForCausalLM.from_pretrained(
+            ONNX_MODEL_PATH,
+            provider="CoreMLExecutionProvider" if DEVICE == "mps" else "CPUExecutionProvider",
+        )
+        # ONNX Runtime takes its inputs from CPU memory (also with the CoreML provider).
+        DEVICE = "cpu"
+    else:
+        # Any device_map creates the model on the meta device and loads the weights straight to their target device,
+        # without materializing a full copy in CPU memory first. On CUDA the whole model is placed on one GPU
+        # ("auto" could split it across GPUs, which breaks the CUDA graphs and the input staging buffers).
+        # For Apple Silicon (mps), device_map="auto" might not always work reliably, so we assign it manually.
+        if WEIGHT_QUANTIZATION == "nf4":
+            # Weights are stored as 4-bit NF4 and computed in float16, so no explicit dtype is passed.
+            quantization = {
+                "quantization_config": BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_compute_dtype=torch.float16,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_use_double_quant=True,
+                )
+            }
+        else:
+            quantization = {"dtype": DTYPE}
+
+        if DEVICE == "cuda":
+            device_map = "cuda"
+        elif DEVICE == "cpu":
+            device_map = "cpu"
+        else:
+            device_map = None  # mps: moved to the device below
+
+        model = AutoModelForCausalLM.from_pretrained(
+            MODEL_PATH,
+            device_map=device_map,
+            attn_implementation=ATTN_IMPLEMENTATION,
+            **quantization,
+        )
+
+        # If using MPS, explicitly move the model to the device.
+        if DEVICE == "mps":
+            model = model.to(DEVICE)
+
+        if WEIGHT_QUANTIZATION == "fp8":
+            # Convert Linear weights to FP8 with per-tensor scales; activations stay in float16.
+            from torchao.quantization import quantize_, float8_weight_only
+            quantize_(model, float8_weight_only())
+
+        # Inference only: switch to eval mode.
+        model.eval()
+
+        if COMPILE_MODEL:
+            # Used by generate() for the decode steps whenever a static cache is passed. The prefill runs
+            # eagerly, so new prompt lengths do not record new CUDA graphs.
+            model.generation_config.compile_config = CompileConfig(fullgraph=True, mode="reduce-overhead")
+
+    # Inference only: disable autograd bookkeeping.
+    torch.set_grad_enabled(False)
+
     logger.info(f"Model loaded successfully on {DEVICE}.")
 except Exception as e:
     # Record a critical error and exit if model loading fails.
@@ -76,6 +249,167 @@ except Exception as e:
     logger.debug(traceback.format_exc())
     raise RuntimeError(f"Failed to load model from {MODEL_PATH}")
 
+# Maximum number of tokens (prompt + generated) per request. The compiled path is limited by its static
+# KV cache; otherwise the model's full context window is used (32K tokens for Gemma 3 1B).
+MAX_CONTEXT = MAX_CACHE_LEN if COMPILE_MODEL else model.config.max_position_embeddings
+
+# Special token ids are resolved once instead of being looked up on every request.
+PAD_ID = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+EOS_ID = tokenizer.eos_token_id
+
+# Token ids that end a response (e.g. <eos> and <end_of_turn> for Gemma).
+STOP_TOKEN_IDS = {EOS_ID}
+if isinstance(model.generation_config.eos_token_id, list):
+    STOP_TOKEN_IDS.update(model.generation_config.eos_token_id)
+elif model.generation_config.eos_token_id is not None:
+    STOP_TOKEN_IDS.add(model.generation_config.eos_token_id)
+
+# -----------------------------------------------------------------------------
+# KV Cache
+# -----------------------------------------------------------------------------
+# Each chat session keeps the KV cache of its last turn, together with the token ids it covers.
+# A conversation only grows between turns, so the next prompt usually starts with those tokens and
+# only the new ones (last response + new message) have to be prefilled.
+# Sessions are only accessed from the generation thread, so no locking is required.
+MAX_SESSIONS = 8
+
+class Session:
+    """KV cache of a chat session and the token ids stored in it"""
+    def __init__(self, cache, token_ids):
+        self.cache = cache          # KV cache after the last turn
+        self.token_ids = token_ids  # Token ids (list of int) covered by the cache
+
+SESSIONS = OrderedDict()  # session_id -> Session, least recently used first
+
+# Static caches that are no longer used are reset and reused instead of allocating new ones.
+# Reusing the same buffers keeps tensor addresses stable, so the captured CUDA graphs are replayed
+# instead of being recorded again. A static cache is sized for the batch it was first used with,
+# so free caches are kept per batch size.
+FREE_STATIC_CACHES = defaultdict(list)  # batch size -> [StaticCache]
+
+def new_kv_cache(batch_size=1):
+    """
+    Creates an empty KV cache (static when compiled, quantized if available, dynamic otherwise).
+    Returns None with ONNX Runtime, which creates its own cache inside generate().
+    """
+    if USE_ONNX:
+        return None
+    if COMPILE_MODEL:
+        if FREE_STATIC_CACHES[batch_size]:
+            return FREE_STATIC_CACHES[batch_size].pop()
+        return StaticCache(config=model.config, max_cache_len=MAX_CACHE_LEN)
+    if QUANTIZE_KV_CACHE:
+        return QuantizedCache(backend="quanto", config=model.config, nbits=KV_CACHE_BITS)
+    return DynamicCache(config=model.config)
+
+def release_kv_cache(cache, batch_size=1):
+    """Returns a KV cache that is no longer used (static caches are recycled)."""
+    if isinstance(cache, StaticCache):
+        cache.reset()
+        FREE_STATIC_CACHES[batch_size].append(cache)
+
+def common_prefix_length(a, b):
+    """Returns the number of leading token ids that `a` and `b` have in common."""
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+def acquire_kv_cache(session_id, token_ids):
+    """
+    Returns the KV cache to generate `token_ids` with and the number of tokens already cached.
+    The session's cache is reused up to the longest common prefix of its tokens and `token_ids`
+    (at least one prompt token is always left to prefill). When the prompt diverges from the cached
+    tokens (e.g. the oldest history was dropped), a dynamic cache is cropped to the common prefix.
+    Static and quantized caches cannot be cropped, so they are replaced by a fresh one instead.
+    """
+    session = SESSIONS.pop(session_id, None)
+    if session is not None:
+        cached_len = common_prefix_length(session.token_ids, token_ids[:-1])
+        if cached_len == len(session.token_ids):
+            return session.cache, cached_len
+        if cached_len > 0 and type(session.cache) is DynamicCache:
+            try:
+                session.cache.crop(cached_len)
+                return session.cache, cached_len
+            except ValueError:
+                pass  # e.g. sliding window layers that already dropped older tokens
+        release_kv_cache(session.cache)
+    return new_kv_cache(), 0
+
+def store_session(session_id, cache, token_ids):
+    """Saves the KV cache of a finished turn, evicting the least recently used sessions."""
+    SESSIONS[session_id] = Session(cache, token_ids)
+    while len(SESSIONS) > MAX_SESSIONS:
+        _, evicted = SESSIONS.popitem(last=False)
+        release_kv_cache(evicted.cache)
+
+# -----------------------------------------------------------------------------
+# Generation Thread
+# -----------------------------------------------------------------------------
+# generate() blocks, so it runs on a single background thread instead of the event loop.
+# One worker means batches are generated one at a time, which the shared model and KV caches require,
+# and the compiled CUDA graphs are always replayed from the same thread.
+GENERATION_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="generate")
+
+class StopOnEvents(StoppingCriteria):
+    """Stopping criterion that ends each sequence of a batch once its threading.Event is set."""
+    def __init__(self, events):
+        self.events = events
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return torch.tensor([event.is_set() for event in self.events], dtype=torch.bool, device=input_ids.device)
+
+class BatchStreamer(BaseStreamer):
+    """Forwards each sequence of a (batched) generate() call to the streamer of its job."""
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def put(self, value):
+        # The first call receives the prompts (shape [batch, length]), then one token per sequence (shape [batch]).
+        # generate() already passes the tokens as CPU tensors, so reading them does not wait on the device.
+        for i, job in enumerate(self.jobs):
+            if job.finished:
+                continue
+            row = value[i:i + 1]
+            job.streamer.put(row)
+            # Close the stream as soon as this sequence is complete, even if others are still generating.
+            if value.dim() == 1 and row.item() in STOP_TOKEN_IDS:
+                job.finish()
+
+    def end(self):
+        for job in self.jobs:
+            if not job.finished:
+                job.finish()
+
+def warm_up(batch_size=1):
+    """
+    Runs a short dummy generation so that the one-off compilation cost
+    (which can take more than a minute) is paid at startup instead of on the first request.
+    Static caches and CUDA graphs are sized per batch, so each batch size needs its own warm-up.
+    """
+    logger.info(f"Warming up compiled model (batch size {batch_size})...")
+    input_ids = tokenizer.apply_chat_template(
+        [{"role": "user", "content": "Hello!"}],
+        return_tensors="pt",
+        add_generation_prompt=True,
+        return_dict=True,
+    )["input_ids"].repeat(batch_size, 1).to(DEVICE)
+    cache = new_kv_cache(batch_size)
+    with torch.inference_mode():
+        model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=16,
+            do_sample=False,
+            pad_token_id=PAD_ID,
+            past_key_values=cache,
+        )
+    release_kv_cache(cache, batch_size)
+    logger.info("Warm-up finished.")
+
 # -----------------------------------------------------------------------------
 # Data Models
 # -----------------------------------------------------------------------------
@@ -90,8 +424,9 @@ class ChatRequest(BaseModel):
     """Structure for the full chat request"""
     message: str                # Current user message
     history: list[Message] = [] # Previous conversation history (default is an empty list)
-    max_length: int = 200       # Maximum number of tokens to generate
+    max_length: int = Field(200, ge=1)  # Maximum number of tokens to generate
     temperature: float = 0.7    # Control diversity (higher is more creative, lower is more consistent)
+    session_id: str | None = None # Opaque id returned in the X-Session-Id header; reuses the KV cache of previous turns
 
 # -----------------------------------------------------------------------------
 # Middleware
@@ -109,8 +444,320 @@ async def log_requests(request: Request, call_next):
         return response
     except Exception as e:
         logger.error(f"Request failed: {e}")
-        # Do not swallow the exception; pass it to the next handler.
-        return await call_next(request) 
+        # Do not swallow the exception; re-raise it instead of calling the endpoint a second time.
+        raise
+
+# -----------------------------------------------------------------------------
+# Tokenization
+# -----------------------------------------------------------------------------
+
+# Tokenized conversations are cached, so retried or repeated conversations skip the template
+# rendering and tokenization work. Only accessed from the generation thread.
+TOKENIZATION_CACHE = OrderedDict()  # conversation -> input ids, least recently used first
+TOKENIZATION_CACHE_SIZE = 256
+
+# Approximate number of template tokens around each message (e.g. "<start_of_turn>user\n" ... "<end_of_turn>\n").
+MESSAGE_OVERHEAD_TOKENS = 5
+
+# Heuristic (not a hard bound) for the most characters a token covers on average. Messages beyond
+# budget * MAX_CHARS_PER_TOKEN characters are assumed not to fit and are dropped without being tokenized.
+# Kept generous, since some tokens (e.g. long whitespace runs) cover many more characters than usual.
+MAX_CHARS_PER_TOKEN = 32
+
+def truncate_messages(messages, max_new_tokens):
+    """
+    Drops the oldest messages until the prompt and the generated tokens fit in MAX_CONTEXT.
+    A cheap character count first drops messages that cannot fit, which bounds the tokenization work
+    (this runs on the event loop) no matter how long the history is. The remaining token counts are
+    estimated per message (content + template overhead) with one batched tokenizer call, so the full
+    prompt is never rendered and prefilled for tokens that would be discarded.
+    A leading system message and the latest message are always kept, and leading assistant turns are
+    dropped so that the conversation still alternates starting with a user turn.
+    Returns an empty tuple if the system message and the latest message do not fit.
+    """
+    budget = MAX_CONTEXT - max_new_tokens
+    max_chars = budget * MAX_CHARS_PER_TOKEN
+
+    # Gemma's template merges a system message into the first user turn, so it is kept separately.
+    system = messages[:1] if len(messages) > 1 and messages[0][0] == "system" else ()
+    turns = messages[len(system):]
+
+    # 1. Character pre-trim (newest messages first)
+    chars = sum(len(content) for _, content in system) + len(turns[-1][1])
+    if chars > max_chars:
+        return ()
+    first = len(turns) - 1
+    while first > 0 and chars + len(turns[first - 1][1]) <= max_chars:
+        first -= 1
+        chars += len(turns[first][1])
+    turns = turns[first:]
+
+    # 2. Token budget
+    kept = system + turns
+    lengths = [
+        len(token_ids) + MESSAGE_OVERHEAD_TOKENS
+        for token_ids in tokenizer([content for _, content in kept], add_special_tokens=False)["input_ids"]
+    ]
+    total = sum(lengths) + MESSAGE_OVERHEAD_TOKENS  # <bos> and the generation prompt
+    turn_lengths = lengths[len(system):]
+
+    start = 0
+    while start < len(turns) - 1 and (total > budget or turns[start][0] == "assistant"):
+        total -= turn_lengths[start]
+        start += 1
+
+    if total > budget:
+        return ()
+    return system + turns[start:]
+
+def tokenize_conversations(conversations):
+    """
+    Tokenizes several conversations with a single (batched) fast-tokenizer call.
+    Returns one list of token ids per conversation, without padding.
+    """
+    if hasattr(tokenizer, "apply_chat_template"):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Applying chat template to {len(conversations)} conversation(s)...")
+        # apply_chat_template adds model-specific special tokens (e.g., <start_of_turn>).
+        input_data = tokenizer.apply_chat_template(
+            [[{"role": role, "content": content} for role, content in messages] for messages in conversations],
+            add_generation_prompt=True # Add prompt to induce assistant response
+        )
+
+        # Handle return type (dictionary or list of token ids)
+        if isinstance(input_data, dict) or hasattr(input_data, "input_ids"):
+            return input_data["input_ids"]
+        return input_data
+
+    # Fallback for models without a chat template
+    logger.debug("Encoding raw text (Template not found)...")
+    contexts = ["\n".join([f"{role}: {content}" for role, content in messages]) for messages in conversations]
+    return tokenizer(contexts)["input_ids"]
+
+def encode_conversations(conversations):
+    """
+    Converts conversations into input token ids (CPU tensors of shape [1, length]).
+    Each conversation is a tuple of (role, content) pairs. Cache misses are tokenized together.
+    The returned tensors are shared through the cache and must not be modified in place.
+    """
+    missing = [messages for messages in dict.fromkeys(conversations) if messages not in TOKENIZATION_CACHE]
+    if missing:
+        for messages, token_ids in zip(missing, tokenize_conversations(missing)):
+            TOKENIZATION_CACHE[messages] = torch.tensor([token_ids], dtype=torch.long)
+
+    encoded = []
+    for messages in conversations:
+        TOKENIZATION_CACHE.move_to_end(messages)
+        encoded.append(TOKENIZATION_CACHE[messages])
+
+    while len(TOKENIZATION_CACHE) > TOKENIZATION_CACHE_SIZE:
+        TOKENIZATION_CACHE.popitem(last=False)
+    return encoded
+
+# -----------------------------------------------------------------------------
+# Batching
+# -----------------------------------------------------------------------------
+# Decoding a single sequence leaves most of the GPU idle, so concurrent requests are collected into
+# micro-batches and generated together with one generate() call.
+MAX_BATCH = 4                  # Maximum number of requests generated together
+BATCH_WAIT_TIMEOUT_S = 0.002   # How long to wait for more requests after the first one arrives
+
+class GenerationJob:
+    """A chat request waiting to be generated"""
+    def __init__(self, session_id, messages, max_new_tokens, temperature):
+        self.session_id = session_id
+        self.messages = messages              # Conversation as a tuple of (role, content) pairs
+        self.token_ids = None                 # Prompt token ids (list of int), set by encode_jobs()
+        self.input_ids = None                 # Prompt token ids (CPU tensor of shape [1, length]), set by encode_jobs()
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        # Receives the generated tokens and yields decoded text chunks as they are produced.
+        self.streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+        # Set when the client disconnects so that generation stops early instead of wasting compute.
+        self.stop_event = threading.Event()
+        self.finished = False
+        self.error = None                     # Exception raised during generation, if any
+
+    def finish(self, error=None):
+        """Ends the response stream (with an error if generation failed)."""
+        self.error = error
+        self.finished = True
+        self.streamer.end()
+
+JOB_QUEUE = asyncio.Queue()
+
+# Input Staging Buffers:
+# Prompts are written into a persistent host buffer (pinned on CUDA) and copied asynchronously into a
+# persistent device buffer, instead of allocating new tensors and doing a synchronous pageable copy
+# for every batch. The buffers are flat so that every [batch, length] view of them is contiguous.
+# Only used from the generation thread, one batch at a time.
+HOST_INPUT_IDS = torch.empty(MAX_BATCH * MAX_CONTEXT, dtype=torch.long, pin_memory=DEVICE == "cuda")
+HOST_ATTENTION_MASK = torch.empty(MAX_BATCH * MAX_CONTEXT, dtype=torch.long, pin_memory=DEVICE == "cuda")
+DEVICE_INPUT_IDS = torch.empty(MAX_BATCH * MAX_CONTEXT, dtype=torch.long, device=DEVICE)
+DEVICE_ATTENTION_MASK = torch.empty(MAX_BATCH * MAX_CONTEXT, dtype=torch.long, device=DEVICE)
+
+def stage_inputs(jobs):
+    """
+    Copies the prompts of `jobs`, left-padded to the same length, into the staging buffers.
+    Returns device views for the input ids and attention mask (shape [len(jobs), max prompt length]).
+    """
+    shape = (len(jobs), max(len(job.token_ids) for job in jobs))
+    size = shape[0] * shape[1]
+    host_ids = HOST_INPUT_IDS[:size].view(shape).fill_(PAD_ID)
+    host_mask = HOST_ATTENTION_MASK[:size].view(shape).zero_()
+    for i, job in enumerate(jobs):
+        host_ids[i, shape[1] - len(job.token_ids):] = job.input_ids[0]
+        host_mask[i, shape[1] - len(job.token_ids):] = 1
+
+    device_ids = DEVICE_INPUT_IDS[:size].view(shape)
+    device_mask = DEVICE_ATTENTION_MASK[:size].view(shape)
+    device_ids.copy_(host_ids, non_blocking=True)
+    device_mask.copy_(host_mask, non_blocking=True)
+    return device_ids, device_mask
+
+def encode_jobs(jobs):
+    """
+    Tokenizes the prompts of all collected jobs at once. Returns the jobs that were encoded.
+    If the batched call fails (e.g. a conversation whose roles do not alternate), each job is encoded
+    on its own so that only the offending jobs are finished with the error.
+    """
+    try:
+        encoded = encode_conversations([job.messages for job in jobs])
+    except Exception:
+        if len(jobs) == 1:
+            raise
+        encoded_jobs = []
+        for job in jobs:
+            try:
+                encoded_jobs += encode_jobs([job])
+            except Exception as e:
+                job.finish(e)
+        return encoded_jobs
+
+    for job, input_ids in zip(jobs, encoded):
+        job.input_ids = input_ids
+        job.token_ids = input_ids[0].tolist()
+    return jobs
+
+# Temperatures at or below this are treated as 0 and decoded greedily.
+GREEDY_TEMPERATURE = 1e-5
+
+# The greedy and sampling settings are kept in two prebuilt configs; each batch only sets max_new_tokens
+# (and temperature) on a copy. generate() still copies and validates the config and fills unset fields
+# from model.generation_config, so this keeps the settings in one place rather than saving per-call work.
+# - Greedy decoding (argmax) skips the softmax and multinomial sampling kernels.
+GREEDY_GEN_CFG = copy.deepcopy(model.generation_config)
+GREEDY_GEN_CFG.update(do_sample=False, num_beams=1, pad_token_id=PAD_ID)
+# - Sampling: top_k=0 disables the extra top-k sort; temperature (and top-p) still shape the distribution.
+SAMPLE_GEN_CFG = copy.deepcopy(model.generation_config)
+SAMPLE_GEN_CFG.update(do_sample=True, top_k=0, pad_token_id=PAD_ID)
+
+def run_generate(jobs, input_ids, attention_mask, cache):
+    """Runs generate() for jobs that share the same generation parameters."""
+    if jobs[0].temperature <= GREEDY_TEMPERATURE:
+        generation_config = copy.copy(GREEDY_GEN_CFG)
+    else:
+        generation_config = copy.copy(SAMPLE_GEN_CFG)
+        generation_config.temperature = jobs[0].temperature  # Control probability distribution
+    generation_config.max_new_tokens = jobs[0].max_new_tokens  # Maximum number of new tokens to generate
+
+    # inference_mode skips autograd version counters and metadata on every op.
+    with torch.inference_mode():
+        return model.generate(
+            input_ids,
+            attention_mask=attention_mask,          # Explicitly pass attention mask
+            generation_config=generation_config,
+            past_key_values=cache,                  # KV cache (static when compiled, quantized if available)
+            streamer=BatchStreamer(jobs),
+            stopping_criteria=StoppingCriteriaList([StopOnEvents([job.stop_event for job in jobs])]),
+        )
+
+def generate_single(job):
+    """Generates one request, reusing and then storing its session's KV cache."""
+    # Reuse the session's KV cache when it already holds the start of this prompt.
+    # generate() then only prefills the tokens after the cached prefix.
+    cache, cached_len = acquire_kv_cache(job.session_id, job.token_ids)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Session {job.session_id}: {cached_len}/{len(job.token_ids)} prompt tokens cached")
+
+    # A single unpadded sequence attends to every token, so no comparison against PAD_ID is needed.
+    input_ids, attention_mask = stage_inputs([job])
+    try:
+        outputs = run_generate([job], input_ids, attention_mask, cache)
+    except Exception:
+        release_kv_cache(cache)
+        raise
+    if cache is None:
+        return  # ONNX Runtime: nothing to keep for the next turn
+    # The last generated token is never fed back to the model, so the cache covers all tokens but it.
+    store_session(job.session_id, cache, outputs[0, :-1].tolist())
+
+def generate_batch(jobs):
+    """Generates several requests together. Prompts are left-padded to the same length."""
+    input_ids, attention_mask = stage_inputs(jobs)
+
+    # A batch's KV cache mixes several conversations, so it is not kept as a session cache.
+    # Earlier session caches of these jobs stay stored: they still hold a prefix of the conversation
+    # that the next turn can reuse if it runs alone.
+    cache = new_kv_cache(len(jobs))
+    try:
+        run_generate(jobs, input_ids, attention_mask, cache)
+    finally:
+        release_kv_cache(cache, len(jobs))
+
+def run_jobs(jobs):
+    """Generates a micro-batch on the generation thread and reports failures to every waiting client."""
+    try:
+        if len(jobs) == 1:
+            generate_single(jobs[0])
+        else:
+            generate_batch(jobs)
+    except Exception as e:
+        for job in jobs:
+            if not job.finished:
+                job.finish(e)
+
+def group_jobs(jobs):
+    """
+    Splits collected jobs into batches that can share one generate() call, grouped by their generation parameters.
+    Batching takes priority over prefix reuse: a job that ends up alone reuses and keeps its session's KV cache,
+    while jobs in a larger batch are prefilled in full with a fresh cache.
+    """
+    batches = {}
+    for job in jobs:
+        if job.stop_event.is_set():
+            continue  # Client already disconnected
+        batches.setdefault((job.max_new_tokens, job.temperature), []).append(job)
+    return list(batches.values())
+
+async def batch_scheduler():
+    """Collects queued jobs into micro-batches and runs them on the generation thread."""
+    loop = asyncio.get_running_loop()
+    while True:
+        jobs = [await JOB_QUEUE.get()]
+        deadline = loop.time() + BATCH_WAIT_TIMEOUT_S
+        while len(jobs) < MAX_BATCH:
+            try:
+                jobs.append(await asyncio.wait_for(JOB_QUEUE.get(), deadline - loop.time()))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            jobs = await loop.run_in_executor(GENERATION_EXECUTOR, encode_jobs, jobs)
+        except Exception as e:
+            for job in jobs:
+                job.finish(e)
+            continue
+
+        for batch in group_jobs(jobs):
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Generating a batch of {len(batch)} request(s)...")
+            await loop.run_in_executor(GENERATION_EXECUTOR, run_jobs, batch)
+
+# Compile the decode step for every batch size the scheduler can produce, so no request waits for a compilation.
+if COMPILE_MODEL:
+    for batch_size in range(1, MAX_BATCH + 1):
+        GENERATION_EXECUTOR.submit(warm_up, batch_size).result()
 
 # -----------------------------------------------------------------------------
 # Endpoints
@@ -128,67 +775,61 @@ async def chat(request: ChatRequest):
     Chat Endpoint:
     1. Receives user input and conversation history.
     2. Converts it into a prompt format understood by the model.
-    3. Generates a response using the model.
-    4. Decodes the generated tokens into text and returns it.
+    3. Queues the request; concurrent requests are generated together in micro-batches.
+    4. Streams the decoded text back as Server-Sent Events while it is being generated.
+       Each event is `data: {"delta": "..."}`; the stream ends with `data: [DONE]`
+       (or `data: {"error": "..."}` if generation fails).
     """
     logger.info(f"Chat request received. Length: {len(request.message)}, History: {len(request.history)}, Max tokens: {request.max_length}")
     try:
         # 1. Construct messages: Previous history + current user message
-        messages = []
-        for msg in request.history:
-            messages.append({"role": msg.role, "content": msg.content})
+        # Stored as a tuple of (role, content) pairs so it can be used as a tokenization cache key.
+        messages = tuple((msg.role, msg.content) for msg in request.history)
         
         # Add latest user message
-        messages.append({"role": "user", "content": request.message})
-
-        # 2. Apply chat template and tokenize
-        if hasattr(tokenizer, "apply_chat_template"):
-            logger.debug(f"Applying chat template with {len(messages)} messages...")
-            # apply_chat_template adds model-specific special tokens (e.g., <start_of_turn>).
-            input_data = tokenizer.apply_chat_template(
-                messages, 
-                return_tensors="pt", # Return as PyTorch tensors
-                add_generation_prompt=True # Add prompt to induce assistant response
-            )
-            
-            # Handle return type (dictionary or tensor)
-            if isinstance(input_data, dict) or hasattr(input_data, "input_ids"):
-                 input_ids = input_data["input_ids"]
-            else:
-                 input_ids = input_data
-
-            # Move data to computation device (GPU/CPU)
-            input_ids = input_ids.to(DEVICE)
-        else:
-            # Fallback for models without a chat template
-            logger.debug("Encoding raw text (Template not found)...")
-            context = "\n".join([f"{m['role']}: {m['content']}" for m in messages])
-            input_ids = tokenizer.encode(context, return_tensors="pt").to(DEVICE)
+        messages += (("user", request.message),)
 
-        logger.debug(f"Input tensor shape: {input_ids.shape}")
+        # Drop the oldest messages that do not fit in the context (bounds prefill time and memory)
+        truncated = truncate_messages(messages, request.max_length)
+        if not truncated:
+            raise HTTPException(status_code=400, detail=f"Message (with system prompt) and max_length exceed the context size ({MAX_CONTEXT} tokens)")
+        if len(truncated) < len(messages):
+            logger.info(f"History truncated from {len(messages)} to {len(truncated)} messages to fit the context.")
+        messages = truncated
 
-        # 3. Generate text using the model (Inference)
-        logger.debug("Generating response...")
-        
-        # Create attention mask (prevents warnings and improves accuracy when pad_token == eos_token)
-        attention_mask = (input_ids != tokenizer.pad_token_id).long()
-        
-        outputs = model.generate(
-            input_ids,
-            attention_mask=attention_mask,     # Explicitly pass attention mask
-            max_new_tokens=request.max_length, # Maximum number of new tokens to generate
-            temperature=request.temperature,   # Control probability distribution
-            do_sample=True,                    # Use sampling (enable diversity)
-            pad_token_id=tokenizer.eos_token_id # Set padding token to prevent errors
+        # 2-3. Queue the request for the batching scheduler, which applies the chat template and
+        # tokenizes all requests of a micro-batch together before generating (Inference)
+        logger.debug("Queueing generation...")
+        session_id = request.session_id or uuid.uuid4().hex
+        job = GenerationJob(session_id, messages, request.max_length, request.temperature)
+        await JOB_QUEUE.put(job)
+
+        # 4. Stream the decoded text as Server-Sent Events (SSE)
+        def event_stream():
+            try:
+                for text in job.streamer:
+                    if text:
+                        yield f"data: {json.dumps({'delta': text})}\n\n"
+
+                if job.error is not None:
+                    logger.error(f"Error during chat generation: {job.error}")
+                    logger.error("".join(traceback.format_exception(job.error)))
+                    yield f"data: {json.dumps({'error': str(job.error)})}\n\n"
+                    return
+
+                logger.info("Response generated successfully.")
+                yield "data: [DONE]\n\n"
+            finally:
+                # Runs on completion as well as on client disconnect.
+                job.stop_event.set()
+
+        return StreamingResponse(
+            event_stream(),
+            media_type="text/event-stream",
+            headers={"X-Session-Id": session_id},
         )
-        
-        # 4. Decode result
-        logger.debug("Decoding response...")
-        # Extract only the newly generated part (after input_ids) and decode to text.
-        response_text = tokenizer.decode(outputs[0][input_ids.shape[-1]:], skip_special_tokens=True)
-        
-        logger.info("Response generated successfully.")
-        return {"response": response_text}
+    except HTTPException:
+        raise
     except Exception as e:
         # Record detailed logs and return 500 status code in case of error.
         logger.error(f"Error during chat generation: {e}")
@@ -198,4 +839,7 @@ async def chat(request: ChatRequest):
 if __name__ == "__main__":
     import uvicorn
     # Start server: 0.0.0.0 allows access from all network interfaces.
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvicorn picks uvloop and httptools when installed (see requirements.txt; uvloop is not available on Windows),
+    # which lowers the event loop and HTTP parsing overhead per request.
+    # A single worker keeps one copy of the model in (GPU) memory; the batching scheduler handles concurrency.
+    uvicorn.run(app, host="0.0.0.0", port=8000, workers=1, log_level="warning")
@@ -1,6 +1,12 @@
+import json
+
 import httpx
 
-API_URL = "http://localhost:8000/chat"
+BASE_URL = "http://localhost:8000"
+# The server truncates the history to its context size (at most 32K tokens). The client only drops the
+# oldest turns beyond this many characters, well above what the server can fit, so requests stay bounded
+# without changing what the model sees.
+MAX_HISTORY_CHARS = 200_000
 
 
 def main():
@@ -10,81 +16,103 @@ def main():
     print("-" * 50)
 
     history = []
-
-    # Simple check if server is up
-    try:
-        httpx.get("http://localhost:8000/", timeout=2.0)
-    except httpx.RequestError:
-        print(
-            "Warning: Could not connect to http://localhost:8000. Make sure the server is running via './run.sh'"
-        )
-        print("-" * 50)
-
-    while True:
+    session_id = None  # Lets the server reuse the KV cache of previous turns
+
+    # One client for the whole session keeps the connection alive between turns
+    # (no new TCP handshake per message). Generous timeout for generation.
+    with httpx.Client(
+        base_url=BASE_URL, timeout=120.0, headers={"Connection": "keep-alive"}
+    ) as client:
+        # Simple check if server is up
         try:
-            user_input = input("You: ").strip()
-
-            if not user_input:
-                continue
-
-            if user_input.lower() in ["quit", "exit"]:
-                print("Goodbye!")
-                break
-
-            if user_input.lower() == "clear":
-                history = []
-                print("History cleared.")
-                continue
-
-            payload = {
-                "message": user_input,
-                "history": history[-10:],  # Send last 10 messages
-                "max_length": 500,
-                "temperature": 0.7,
-            }
-
-            print("Bot: ...", end="\r", flush=True)
+            client.get("/", timeout=2.0)
+        except httpx.RequestError:
+            print(
+                f"Warning: Could not connect to {BASE_URL}. Make sure the server is running via './run.sh'"
+            )
+            print("-" * 50)
 
+        while True:
             try:
-                # Generous timeout for generation
-                response = httpx.post(API_URL, json=payload, timeout=120.0)
-                response.raise_for_status()
+                user_input = input("You: ").strip()
 
-                print("Bot: ", end="", flush=True)
+                if not user_input:
+                    continue
 
-                data = response.json()
-                bot_response = data.get("response", "").strip()
+                if user_input.lower() in ["quit", "exit"]:
+                    print("Goodbye!")
+                    break
 
-                print(bot_response)
+                if user_input.lower() == "clear":
+                    history = []
+                    session_id = None
+                    print("History cleared.")
+                    continue
 
-                # Update history
-                history.append({"role": "user", "content": user_input})
-                history.append({"role": "assistant", "content": bot_response})
+                payload = {
+                    "message": user_input,
+                    # Send the history up to MAX_HISTORY_CHARS: the server truncates it to its context size and
+                    # can only reuse the KV cache of previous turns if older messages are still included.
+                    "history": history,
+                    "max_length": 500,
+                    "temperature": 0.7,
+                    "session_id": session_id,
+                }
 
-                # Keep history manageable locally too
-                if len(history) > 20:  # 10 pairs
-                    history = history[-20:]
+                print("Bot: ...", end="\r", flush=True)
 
-            except httpx.HTTPStatusError as e:
-                print(f"\nError: Server returned status {e.response.status_code}")
                 try:
-                    detail = e.response.json().get("detail", "No detail")
-                    print(f"Detail: {detail}")
-                except Exception:
-                    pass
-            except httpx.RequestError as e:
-                print(f"\nError: Could not connect to server. ({e})")
-            except Exception as e:
-                print(f"\nAn error occurred: {e}")
-
-            print("-" * 50)
-
-        except KeyboardInterrupt:
-            print("\nGoodbye!")
-            break
-        except EOFError:
-            print("\nGoodbye!")
-            break
+                    with client.stream("POST", "/chat", json=payload) as response:
+                        if response.is_error:
+                            response.read()  # Load the body so the error detail can be shown below
+                        response.raise_for_status()
+                        session_id = response.headers.get("X-Session-Id", session_id)
+
+                        print("Bot: ", end="", flush=True)
+
+                        # The server streams Server-Sent Events: `data: {"delta": "..."}` ... `data: [DONE]`
+                        chunks = []
+                        for line in response.iter_lines():
+                            if not line.startswith("data: "):
+                                continue
+                            data = line[len("data: "):]
+                            if data == "[DONE]":
+                                break
+                            event = json.loads(data)
+                            if "error" in event:
+                                raise RuntimeError(event["error"])
+                            print(event["delta"], end="", flush=True)
+                            chunks.append(event["delta"])
+
+                    print()
+                    bot_response = "".join(chunks).strip()
+
+                    # Update history
+                    history.append({"role": "user", "content": user_input})
+                    history.append({"role": "assistant", "content": bot_response})
+                    while sum(len(m["content"]) for m in history) > MAX_HISTORY_CHARS:
+                        history = history[2:]  # Drop the oldest user/assistant pair
+
+                except httpx.HTTPStatusError as e:
+                    print(f"\nError: Server returned status {e.response.status_code}")
+                    try:
+                        detail = e.response.json().get("detail", "No detail")
+                        print(f"Detail: {detail}")
+                    except Exception:
+                        pass
+                except httpx.RequestError as e:
+                    print(f"\nError: Could not connect to server. ({e})")
+                except Exception as e:
+                    print(f"\nAn error occurred: {e}")
+
+                print("-" * 50)
+
+            except KeyboardInterrupt:
+                print("\nGoodbye!")
+                break
+            except EOFError:
+                print("\nGoodbye!")
+                break
 
 
 if __name__ == "__main__":
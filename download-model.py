@@ -1,4 +1,5 @@
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer
+from huggingface_hub import snapshot_download
 import os
 from dotenv import load_dotenv
 
@@ -11,12 +12,15 @@ if not os.path.exists("models"):
 
 token = os.getenv("HUGGINGFACE_TOKEN")
 model_id = "google/gemma-3-1b-it"
-cache_dir = "./models"
+local_dir = "./models/gemma3-1b-it"  # MODEL_PATH in api.py
 
-print(f"Downloading/Loading model '{model_id}' into '{cache_dir}'...")
+print(f"Downloading model '{model_id}' into '{local_dir}'...")
 
-# Load tokenizer and model, specifying the cache directory
-tokenizer = AutoTokenizer.from_pretrained(model_id, token=token, cache_dir=cache_dir)
-model = AutoModelForCausalLM.from_pretrained(model_id, token=token, cache_dir=cache_dir)
+# Download the model files to disk without loading the model into memory.
+# Files that are already up to date in local_dir are not downloaded again.
+snapshot_download(repo_id=model_id, local_dir=local_dir, token=token)
 
-print("Model loaded successfully.")
\ No newline at end of file
+# Load the tokenizer (small) to check that the download is usable
+tokenizer = AutoTokenizer.from_pretrained(local_dir)
+
+print("Model downloaded successfully.")
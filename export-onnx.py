@@ -0,0 +1,21 @@
+from optimum.exporters.onnx import main_export
+import os
+
+
+model_dir = "./models/gemma3-1b-it"  # Downloaded by download-model.py (MODEL_PATH in api.py)
+output_dir = "./models/gemma3-1b-it-onnx"
+
+if not os.path.isdir(model_dir):
+    raise SystemExit(f"Model not found in '{model_dir}'. Run 'python download-model.py' first.")
+
+print(f"Exporting model '{model_dir}' to ONNX in '{output_dir}'...")
+
+# Export the model with its KV cache inputs/outputs ("-with-past") so generation reuses past keys/values.
+# api.py loads it with ONNX Runtime when no CUDA GPU is available.
+main_export(
+    model_dir,
+    output=output_dir,
+    task="text-generation-with-past",
+)
+
+print("Model exported successfully.")